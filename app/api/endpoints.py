@@ -1,22 +1,39 @@
 import os
 import uuid
+import shutil
 from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, BackgroundTasks, Form
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, selectinload
 import pandas as pd
 from datetime import datetime
 from typing import Optional
-import re
+import string
 from pathlib import Path
+from urllib.parse import quote
 
 from app.database.db import get_db, Request, Product, ProcessingStatus
-from app.services.csv_service import validate_csv_format, process_csv_file, CSVValidationError, generate_output_csv
+from app.services.csv_service import validate_csv_format, process_csv_file, CSVValidationError, iter_output_csv
+from celery import chord
 from celery_app import celery_app
 from app.models.schemas import UploadResponse, StatusResponse, RequestDetailsResponse, ProductResponse, UploadRequest
 from app.config import UPLOAD_DIR, PROCESSED_DIR
 
 router = APIRouter()
 
+# Size of the chunks used when saving uploaded files to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Resolved once so image requests don't re-resolve the processed directory
+_PROCESSED_ROOT = str(Path(PROCESSED_DIR).resolve())
+
+# Characters and extensions allowed in processed image filenames
+_FILENAME_CHARS = frozenset(string.ascii_letters + string.digits + '_-')
+_IMAGE_EXTENSIONS = frozenset(['jpg', 'jpeg', 'png', 'gif', 'webp'])
+
+# Processed image filenames are never reused, so they can be cached indefinitely
+IMAGE_CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+
 @router.post("/upload", response_model=UploadResponse)
 async def upload_csv(
     background_tasks: BackgroundTasks,
@@ -41,15 +58,25 @@ async def upload_csv(
     file_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}_{file.filename}")
     
     try:
+        # Stream the upload to disk in chunks off the event loop
         with open(file_path, "wb") as f:
-            f.write(await file.read())
+            await run_in_threadpool(shutil.copyfileobj, file.file, f, UPLOAD_CHUNK_SIZE)
         
         # Process the CSV file and get request ID
         request_id = process_csv_file(file_path, db, webhook_url)
         
-        # Try to start asynchronous processing
+        # Try to start asynchronous processing, one task per product, published in bulk
         try:
-            celery_app.send_task('process_images_task', args=[request_id])
+            # Mark the request as processing before dispatch, so the finalize task always runs after it
+            request = db.query(Request).filter(Request.id == request_id).first()
+            request.status = ProcessingStatus.PROCESSING
+            db.commit()
+            
+            product_ids = [product_id for (product_id,) in db.query(Product.id).filter(Product.request_id == request_id)]
+            chord(
+                celery_app.signature('process_product_task', args=[product_id])
+                for product_id in product_ids
+            )(celery_app.signature('finalize_request_task', args=[request_id], immutable=True))
         except Exception as celery_error:
             print(f"Warning: Could not start Celery task: {str(celery_error)}")
             request = db.query(Request).filter(Request.id == request_id).first()
@@ -64,7 +91,7 @@ async def upload_csv(
         return {
             "request_id": request_id,
             "message": "CSV file uploaded successfully and processing has started",
-            "status": ProcessingStatus.PENDING,
+            "status": ProcessingStatus.PROCESSING,
             "webhook_url": webhook_url
         }
     except CSVValidationError as e:
@@ -121,19 +148,16 @@ def get_request_details(request_id: str, db: Session = Depends(get_db)):
     """
     Get detailed information about a processing request, including product details.
     """
-    request = db.query(Request).filter(Request.id == request_id).first()
+    request = db.query(Request).options(selectinload(Request.products)).filter(Request.id == request_id).first()
     if not request:
         raise HTTPException(status_code=404, detail=f"Request with ID {request_id} not found")
     
-    # Get all products for this request
-    products = db.query(Product).filter(Product.request_id == request_id).all()
-    
     # Calculate completion percentage
     completion_percentage = (request.processed_products / request.total_products * 100) if request.total_products > 0 else 0
     
     # Build response
     product_responses = []
-    for product in products:
+    for product in request.products:
         product_responses.append(ProductResponse(
             serial_number=product.serial_number,
             product_name=product.product_name,
@@ -170,6 +194,13 @@ def get_request_details(request_id: str, db: Session = Depends(get_db)):
         "completion_percentage": completion_percentage
     }
 
+def _attachment_disposition(filename):
+    """Build an attachment Content-Disposition header, quoting the filename as FileResponse does."""
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
 @router.get("/download/{request_id}")
 def download_processed_csv(request_id: str, db: Session = Depends(get_db)):
     """
@@ -183,15 +214,11 @@ def download_processed_csv(request_id: str, db: Session = Depends(get_db)):
     if request.status != ProcessingStatus.COMPLETED:
         raise HTTPException(status_code=400, detail="CSV is only available for completed requests")
     
-    # Generate CSV file
-    output_path = generate_output_csv(request_id, db)
-    if not output_path or not os.path.exists(output_path):
-        raise HTTPException(status_code=500, detail="Error generating output CSV")
-    
-    return FileResponse(
-        output_path,
+    # Stream the CSV straight from the database
+    return StreamingResponse(
+        iter_output_csv(request_id),
         media_type="text/csv",
-        filename=f"processed_{request.csv_filename}"
+        headers={"Content-Disposition": _attachment_disposition(f"processed_{request.csv_filename}")}
     )
 
 @router.get("/image/{filename}")
@@ -200,7 +227,8 @@ async def get_processed_image(filename: str):
     Serve a processed image file by filename.
     """
     # Validate filename format
-    if not re.match(r'^[a-zA-Z0-9_-]+\.(jpg|jpeg|png|gif|webp)$', filename.lower()):
+    stem, _, extension = filename.rpartition('.')
+    if not stem or extension.lower() not in _IMAGE_EXTENSIONS or not set(stem) <= _FILENAME_CHARS:
         raise HTTPException(
             status_code=400,
             detail="Invalid filename format"
@@ -210,7 +238,7 @@ async def get_processed_image(filename: str):
     file_path = Path(PROCESSED_DIR) / filename
     try:
         file_path = file_path.resolve()
-        if not str(file_path).startswith(str(Path(PROCESSED_DIR).resolve())):
+        if not str(file_path).startswith(_PROCESSED_ROOT):
             raise HTTPException(
                 status_code=400,
                 detail="Invalid file path"
@@ -242,5 +270,6 @@ async def get_processed_image(filename: str):
     return FileResponse(
         str(file_path),
         media_type=content_type,
-        filename=filename
+        filename=filename,
+        headers=IMAGE_CACHE_HEADERS
     )
\ No newline at end of file
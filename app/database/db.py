@@ -1,14 +1,25 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Index, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, reconstructor
 from datetime import datetime
 from enum import Enum
-import json
+import orjson
 
 from app.config import DATABASE_URL
 
 # Create SQLAlchemy engine
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+# Use WAL so readers don't block the worker's writes, and batch fsyncs
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -22,7 +33,7 @@ class Request(Base):
     __tablename__ = "requests"
 
     id = Column(String, primary_key=True, index=True)
-    status = Column(String, default=ProcessingStatus.PENDING)
+    status = Column(String, default=ProcessingStatus.PENDING, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     csv_filename = Column(String)
@@ -48,19 +59,34 @@ class Product(Base):
     
     request = relationship("Request", back_populates="products")
     
+    @reconstructor
+    def _init_on_load(self):
+        self._input_urls_cache = None
+        self._output_urls_cache = None
+    
     def get_input_urls(self):
-        return json.loads(self.input_image_urls)
+        # Cache the decoded list alongside the raw value it was decoded from
+        cache = getattr(self, "_input_urls_cache", None)
+        if cache is None or cache[0] is not self.input_image_urls:
+            cache = self._input_urls_cache = (self.input_image_urls, orjson.loads(self.input_image_urls))
+        return cache[1]
     
     def set_input_urls(self, urls):
-        self.input_image_urls = json.dumps(urls)
+        self.input_image_urls = orjson.dumps(urls).decode()
     
     def get_output_urls(self):
         if not self.output_image_urls:
             return []
-        return json.loads(self.output_image_urls)
+        cache = getattr(self, "_output_urls_cache", None)
+        if cache is None or cache[0] is not self.output_image_urls:
+            cache = self._output_urls_cache = (self.output_image_urls, orjson.loads(self.output_image_urls))
+        return cache[1]
     
     def set_output_urls(self, urls):
-        self.output_image_urls = json.dumps(urls)
+        self.output_image_urls = orjson.dumps(urls).decode()
+
+# Serves product lookups by request and the per-request status counts
+Index('ix_product_request_status', Product.request_id, Product.status)
 
 # Create tables
 def create_tables():
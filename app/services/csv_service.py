@@ -4,53 +4,60 @@ import uuid
 import os
 from sqlalchemy.orm import Session
 from datetime import datetime
-import json
+import orjson
 from typing import Optional
+from itertools import islice
 
-from app.database.db import Request, Product, ProcessingStatus
-from app.config import UPLOAD_DIR
+from app.database.db import SessionLocal, Request, Product, ProcessingStatus
+
+# Number of CSV rows validated and inserted at a time
+CSV_CHUNK_SIZE = 10_000
+
+# Number of products written per chunk of the output CSV
+OUTPUT_CSV_BATCH_SIZE = 1000
+
+REQUIRED_COLUMNS = ["S. No.", "Product Name", "Input Image Urls"]
 
 class CSVValidationError(Exception):
     pass
 
-def validate_csv_format(file_path):
-    """Validate the CSV file format."""
+def validate_csv_format(file_path, chunksize=CSV_CHUNK_SIZE):
+    """Validate the CSV file format, yielding its rows as DataFrame chunks."""
     try:
-        # First read the raw CSV file to properly handle the URLs
+        # Read the raw CSV file to properly handle the unquoted URLs
         with open(file_path, 'r') as f:
             header = f.readline().strip().split(',')
-            if not all(col in header for col in ["S. No.", "Product Name", "Input Image Urls"]):
+            if not all(col in header for col in REQUIRED_COLUMNS):
                 raise CSVValidationError("Missing required columns")
             
             if len(header) != 3:  # Ensure we have exactly 3 columns
                 raise CSVValidationError("Invalid number of columns")
             
-            # Read and validate each line
-            data = []
-            for idx, line in enumerate(f, 1):
-                # Get everything after the first two commas as the URL string
-                parts = line.strip().split(',', 2)
-                if len(parts) != 3:
-                    raise CSVValidationError(f"Missing data in row {idx}")
+            # Read and validate the file chunk by chunk
+            first_row = 1
+            while True:
+                lines = list(islice(f, chunksize))
+                if not lines:
+                    break
                 
-                serial_no, product_name, urls = parts
+                # Get everything after the first two commas as the URL string
+                chunk = pd.Series(lines).str.strip().str.split(',', n=2, expand=True)
+                chunk = chunk.reindex(columns=range(3))
+                chunk.columns = REQUIRED_COLUMNS
+                chunk.index = range(first_row, first_row + len(chunk))
+                first_row += len(chunk)
                 
-                if not serial_no or not product_name or not urls:
-                    raise CSVValidationError(f"Missing data in row {idx}")
+                missing = (chunk.isna() | (chunk == "")).any(axis=1)
+                if missing.any():
+                    raise CSVValidationError(f"Missing data in row {missing.idxmax()}")
                 
-                # Validate URLs
-                url_list = [url.strip() for url in urls.split(',')]
-                if not url_list or any(not url.startswith('http') for url in url_list):
-                    raise CSVValidationError(f"Invalid image URL format in row {idx}")
+                # Validate URLs, one URL per entry across the whole chunk
+                urls = chunk["Input Image Urls"].str.split(',').explode().str.strip()
+                valid = urls.str.startswith('http')
+                if not valid.all():
+                    raise CSVValidationError(f"Invalid image URL format in row {urls.index[~valid].min()}")
                 
-                data.append({
-                    "S. No.": serial_no,
-                    "Product Name": product_name,
-                    "Input Image Urls": urls
-                })
-        
-        # Convert to DataFrame after validation
-        return pd.DataFrame(data)
+                yield chunk
     
     except Exception as e:
         if isinstance(e, CSVValidationError):
@@ -59,9 +66,6 @@ def validate_csv_format(file_path):
 
 def process_csv_file(file_path, db: Session, webhook_url: Optional[str] = None):
     """Process the CSV file and store data in the database."""
-    # Validate CSV format
-    df = validate_csv_format(file_path)
-    
     # Create a new request
     request_id = str(uuid.uuid4())
     filename = os.path.basename(file_path)
@@ -70,69 +74,58 @@ def process_csv_file(file_path, db: Session, webhook_url: Optional[str] = None):
         id=request_id,
         status=ProcessingStatus.PENDING,
         csv_filename=filename,
-        total_products=len(df),
+        total_products=0,
         processed_products=0,
         webhook_url=webhook_url
     )
     db.add(new_request)
+    db.flush()
     
-    # Add products to the database
-    for idx, row in df.iterrows():
-        serial_number = row["S. No."]
-        product_name = row["Product Name"]
-        input_urls = [url.strip() for url in row["Input Image Urls"].split(",")]
-        
-        new_product = Product(
-            request_id=request_id,
-            serial_number=serial_number,
-            product_name=product_name,
-            input_image_urls=json.dumps(input_urls),
-            status=ProcessingStatus.PENDING
-        )
-        db.add(new_product)
+    try:
+        # Validate the CSV and bulk insert its products chunk by chunk
+        for chunk in validate_csv_format(file_path):
+            rows = [
+                {
+                    "request_id": request_id,
+                    "serial_number": serial_number,
+                    "product_name": product_name,
+                    "input_image_urls": orjson.dumps([url.strip() for url in urls.split(",")]).decode(),
+                    "status": ProcessingStatus.PENDING
+                }
+                for serial_number, product_name, urls in zip(
+                    chunk["S. No."], chunk["Product Name"], chunk["Input Image Urls"]
+                )
+            ]
+            db.bulk_insert_mappings(Product, rows)
+            new_request.total_products += len(rows)
+    except Exception:
+        db.rollback()
+        raise
     
     db.commit()
     return request_id
 
-def generate_output_csv(request_id, db: Session):
-    """Generate output CSV data for a completed request."""
-    # Get request and products
-    request = db.query(Request).filter(Request.id == request_id).first()
-    if not request or request.status != ProcessingStatus.COMPLETED:
-        return None
-    
-    products = db.query(Product).filter(Product.request_id == request_id).all()
-    
-    # Prepare data for the CSV
-    data = []
-    for product in products:
-        input_urls = product.get_input_urls()
-        output_urls = product.get_output_urls()
-        
-        data.append({
-            "S. No.": product.serial_number,
-            "Product Name": product.product_name,
-            "Input Image Urls": ','.join(input_urls),
-            "Output Image Urls": ','.join(output_urls)
-        })
+def iter_output_csv(request_id, batch_size=OUTPUT_CSV_BATCH_SIZE):
+    """Generate output CSV data for a request, yielding it in batches of rows."""
+    yield "S. No.,Product Name,Input Image Urls,Output Image Urls\n"
     
-    # Create DataFrame and save to CSV
-    # df = pd.DataFrame(data)
-    output_path = os.path.join(UPLOAD_DIR, f"output_{request_id}.csv")
-    # df.to_csv(output_path, 
-    #           index=False, 
-    #           quoting=csv.QUOTE_MINIMAL,  # This prevents automatic quoting
-    #           escapechar='\\',  # Use backslash to escape any special characters
-    #           sep=',')
-    with open(output_path, 'w') as f:
-        f.write("S. No.,Product Name,Input Image Urls,Output Image Urls\n")
-        
-        # Write each row manually
+    # Use a dedicated session, since the response is streamed after the request's own
+    # session may already have been closed
+    db = SessionLocal()
+    try:
+        # Write rows manually, matching the unquoted URL format of the input CSV
+        rows = []
+        products = db.query(Product).filter(Product.request_id == request_id).yield_per(batch_size)
         for product in products:
             input_urls = product.get_input_urls()
             output_urls = product.get_output_urls()
             
-            row = f"{product.serial_number},{product.product_name},{','.join(input_urls)},{','.join(output_urls)}\n"
-            f.write(row)
-    
-    return output_path
\ No newline at end of file
+            rows.append(f"{product.serial_number},{product.product_name},{','.join(input_urls)},{','.join(output_urls)}\n")
+            if len(rows) >= batch_size:
+                yield "".join(rows)
+                rows.clear()
+        
+        if rows:
+            yield "".join(rows)
+    finally:
+        db.close()
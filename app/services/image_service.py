@@ -1,21 +1,54 @@
 import os
 import httpx
 import uuid
+import numpy as np
+from blake3 import blake3
 from PIL import Image
 from io import BytesIO
 import asyncio
+from typing import Optional
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+except Exception:  # PyTurboJPEG or the libjpeg-turbo library is not installed
+    _turbo_jpeg = None
+
 from app.config import PROCESSED_DIR, IMAGE_COMPRESSION_QUALITY, API_BASE_URL
 from app.database.db import Product, Request, ProcessingStatus
 
-async def download_image(url):
+JPEG_MAGIC = b'\xff\xd8'
+
+# HTTP client shared across downloads so connections are reused, created lazily
+_http_client = None
+
+def get_http_client():
+    """Get the HTTP client shared by all image downloads, creating it on first use."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=128, max_keepalive_connections=64)
+        )
+    return _http_client
+
+async def close_http_client():
+    """Close the shared HTTP client, if it was created."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+async def download_image(url, client: Optional[httpx.AsyncClient] = None):
     """Download an image from a URL."""
+    client = client or get_http_client()
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, timeout=30.0)
-            response.raise_for_status()
-            return BytesIO(response.content)
+        response = await client.get(url, timeout=30.0)
+        response.raise_for_status()
+        return BytesIO(response.content)
     except Exception as e:
         print(f"Error downloading image from {url}: {str(e)}")
         return None
@@ -23,13 +56,25 @@ async def download_image(url):
 def compress_image(image_data, quality=IMAGE_COMPRESSION_QUALITY):
     """Compress an image to reduce its quality by 50%."""
     try:
+        data = image_data.getvalue()
+        if _turbo_jpeg is not None and data.startswith(JPEG_MAGIC):
+            # JPEGs are re-encoded entirely by libjpeg-turbo, falling back to Pillow
+            # for those it can't decode (e.g. CMYK/YCCK)
+            try:
+                return BytesIO(_turbo_jpeg.encode(_turbo_jpeg.decode(data), quality=quality))
+            except Exception as e:
+                print(f"TurboJPEG could not compress image, falling back to Pillow: {str(e)}")
+        
         img = Image.open(image_data)
-        output = BytesIO()
         
         # Save with reduced quality (JPEG format)
         if img.format == 'PNG':
             img = img.convert('RGB')  # Convert PNG to RGB for JPEG saving
         
+        if _turbo_jpeg is not None and img.mode == 'RGB':
+            return BytesIO(_turbo_jpeg.encode(np.asarray(img), quality=quality, pixel_format=TJPF_RGB))
+        
+        output = BytesIO()
         img.save(output, format='JPEG', quality=quality)
         output.seek(0)
         return output
@@ -37,51 +82,69 @@ def compress_image(image_data, quality=IMAGE_COMPRESSION_QUALITY):
         print(f"Error compressing image: {str(e)}")
         return None
 
-async def process_image(url):
-    """Download and process a single image."""
-    image_data = await download_image(url)
-    if not image_data:
-        return None
+def compress_and_save_image(image_bytes):
+    """Compress raw image bytes and save the result, returning the saved filename."""
+    # Name the file after the source image and quality, so duplicate images are only compressed once
+    digest = blake3(image_bytes + str(IMAGE_COMPRESSION_QUALITY).encode()).hexdigest()[:32]
+    filename = f"{digest}.jpg"
+    output_path = os.path.join(PROCESSED_DIR, filename)
+    if os.path.exists(output_path):
+        return filename
     
-    compressed_data = compress_image(image_data)
+    compressed_data = compress_image(BytesIO(image_bytes))
     if not compressed_data:
         return None
     
-    # Generate a unique filename and save the processed image
-    filename = f"{uuid.uuid4()}.jpg"
-    output_path = os.path.join(PROCESSED_DIR, filename)
-    
-    # Save the compressed image
-    with open(output_path, "wb") as f:
+    # Save the compressed image via a temporary file so readers never see a partial image
+    temp_path = f"{output_path}.{uuid.uuid4()}.tmp"
+    with open(temp_path, "wb") as f:
         f.write(compressed_data.getvalue())
+    os.replace(temp_path, output_path)
+    
+    return filename
+
+async def process_image(url, client: Optional[httpx.AsyncClient] = None):
+    """Download and process a single image."""
+    image_data = await download_image(url, client)
+    if not image_data:
+        return None
+    
+    # Compression is CPU-bound, so keep it off the event loop. This runs in a thread rather
+    # than a process pool: Celery prefork children are daemonic and can't start processes,
+    # and products are already spread across those children
+    filename = await asyncio.to_thread(compress_and_save_image, image_data.getvalue())
+    if not filename:
+        return None
     
     print(f"{API_BASE_URL}/api/image/{filename}")
     # Return the proper API endpoint URL for the image
     return f"{API_BASE_URL}/api/image/{filename}"
 
-async def process_product_images(product_id, db: Session):
+async def process_images(input_urls, client: Optional[httpx.AsyncClient] = None):
+    """Process a list of images concurrently, returning their output URLs in order."""
+    results = await asyncio.gather(
+        *[process_image(url, client) for url in input_urls],
+        return_exceptions=True
+    )
+    output_urls = []
+    for url, result in zip(input_urls, results):
+        if isinstance(result, Exception):
+            print(f"Error processing image {url}: {str(result)}")
+            result = None
+        # Empty string is a placeholder for failed processing
+        output_urls.append(result or "")
+    return output_urls
+
+async def process_product_images(product_id, db: Session, client: Optional[httpx.AsyncClient] = None):
     """Process all images for a product."""
     # Get the product
     product = db.query(Product).filter(Product.id == product_id).first()
     if not product:
         return False
     
-    # Update product status
-    product.status = ProcessingStatus.PROCESSING
-    db.commit()
-    
     try:
-        input_urls = product.get_input_urls()
-        output_urls = []
-        
-        # Process each image
-        for url in input_urls:
-            print(url)
-            processed_url = await process_image(url)
-            if processed_url:
-                output_urls.append(processed_url)
-            else:
-                output_urls.append("")  # Placeholder for failed processing
+        # The product goes straight to completed in a single commit, skipping the processing state
+        output_urls = await process_images(product.get_input_urls(), client)
         
         # Update product with processed images
         product.set_output_urls(output_urls)
@@ -101,16 +164,16 @@ async def update_request_status(request_id, db: Session):
     if not request:
         return
     
-    # Count products by status
-    total = db.query(Product).filter(Product.request_id == request_id).count()
-    completed = db.query(Product).filter(
-        Product.request_id == request_id,
-        Product.status == ProcessingStatus.COMPLETED
-    ).count()
-    failed = db.query(Product).filter(
-        Product.request_id == request_id,
-        Product.status == ProcessingStatus.FAILED
-    ).count()
+    # Count products by status in a single grouped query
+    counts = dict(
+        db.query(Product.status, func.count())
+        .filter(Product.request_id == request_id)
+        .group_by(Product.status)
+        .all()
+    )
+    total = sum(counts.values())
+    completed = counts.get(ProcessingStatus.COMPLETED.value, 0)
+    failed = counts.get(ProcessingStatus.FAILED.value, 0)
     
     # Update request stats
     request.processed_products = completed + failed
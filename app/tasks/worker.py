@@ -1,55 +1,88 @@
 import asyncio
 from celery import shared_task
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
 import httpx
 from datetime import datetime
 from sqlalchemy.orm import Session
 
 from app.database.db import get_db, Product, Request, ProcessingStatus
-from app.services.image_service import process_product_images, update_request_status
+from app.services.image_service import process_product_images, update_request_status, close_http_client
 from app.config import WEBHOOK_URL
 from celery_app import celery_app
 
-@celery_app.task(name='process_images_task')
-def process_images_task(request_id: str):
-    print("yes process_images_task")
-    """Process all images for a request."""
-    # Run in a separate thread as Celery can't handle asyncio natively
-    loop = asyncio.get_event_loop()
-    return loop.run_until_complete(_process_images(request_id))
+# Event loop runner for this worker process, kept open across tasks so the shared
+# HTTP client's connections stay bound to a live loop and are reused
+_runner = None
 
-async def _process_images(request_id):
-    """Asynchronously process all images for a request."""
-    # Get database session
-    db = next(get_db())
+@worker_process_init.connect
+def create_runner_on_init(**kwargs):
+    """Create the worker process's event loop runner."""
+    get_runner()
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def close_runner_on_shutdown(**kwargs):
+    """Close the HTTP client and event loop runner when a worker process exits."""
+    global _runner
+    if _runner is not None:
+        _runner.run(close_http_client())
+        _runner.close()
+        _runner = None
+
+def get_runner():
+    """Get the worker process's event loop runner, creating it on first use."""
+    global _runner
+    if _runner is None:
+        _runner = asyncio.Runner()
+    return _runner
+
+def run_async(coro):
+    """Run a coroutine on the worker process's event loop."""
+    return get_runner().run(coro)
+
+@celery_app.task(name='process_product_task')
+def process_product_task(product_id: int):
+    """Process all images for a single product."""
+    return run_async(_process_product(product_id))
 
+@celery_app.task(name='finalize_request_task')
+def finalize_request_task(request_id: str):
+    """Update a request's status once all of its products are processed."""
+    return run_async(_finalize_request(request_id))
+
+async def _process_product(product_id):
+    """Asynchronously process all images for a product."""
+    db = next(get_db())
     try:
-        # Get all products for the request
-        products = db.query(Product).filter(Product.request_id == request_id).all()
-        
-        # Update request status to processing
-        request = db.query(Request).filter(Request.id == request_id).first()
-        if request:
-            request.status = ProcessingStatus.PROCESSING
+        return await process_product_images(product_id, db)
+    except Exception as e:
+        # Never let the task raise, or the chord fails and the request is never finalized
+        print(f"Error processing product {product_id}: {str(e)}")
+        db.rollback()
+        try:
+            db.query(Product).filter(Product.id == product_id).update({"status": ProcessingStatus.FAILED})
             db.commit()
+        except Exception as e:
+            # Left for _finalize_request to mark as failed
+            print(f"Error marking product {product_id} as failed: {str(e)}")
+        return False
+    finally:
+        db.close()
+
+async def _finalize_request(request_id):
+    """Asynchronously update a request's status and trigger its webhook."""
+    db = next(get_db())
+    try:
+        # Every product task has finished, so any product still unfinished has failed
+        db.query(Product).filter(
+            Product.request_id == request_id,
+            Product.status.notin_([ProcessingStatus.COMPLETED, ProcessingStatus.FAILED])
+        ).update({"status": ProcessingStatus.FAILED}, synchronize_session=False)
+        db.commit()
         
-        # Process each product's images
-        for product in products:
-            await process_product_images(product.id, db)
-            # Update request status after each product
-            await update_request_status(request_id, db)
-        
-        # Check if completed and trigger webhook if needed
+        await update_request_status(request_id, db)
         await trigger_webhook_if_needed(request_id, db)
-        
         return {"status": "success", "request_id": request_id}
-    except Exception as e:
-        # Update request status to failed
-        request = db.query(Request).filter(Request.id == request_id).first()
-        if request:
-            request.status = ProcessingStatus.FAILED
-            db.commit()
-        
-        return {"status": "error", "request_id": request_id, "error": str(e)}
     finally:
         db.close()
 
@@ -22,8 +22,9 @@ celery_app.conf.update(
 )
 
 # Import and register task directly
-from app.tasks.worker import process_images_task
-celery_app.task(name='process_images_task')(process_images_task)
+from app.tasks.worker import process_product_task, finalize_request_task
+celery_app.task(name='process_product_task')(process_product_task)
+celery_app.task(name='finalize_request_task')(finalize_request_task)
 
 if __name__ == '__main__':
     celery_app.start()
\ No newline at end of file